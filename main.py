@@ -1,14 +1,28 @@
+import asyncio
+import base64
+import multiprocessing
 import os
 import shutil
+import sys
+import time
 import uuid
 import zipfile
-from typing import List
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from io import BytesIO
+from tempfile import NamedTemporaryFile
+from typing import List, Union
 
 import uvicorn
-from fastapi import FastAPI, UploadFile, File, Form, Request, HTTPException, BackgroundTasks
-from fastapi.responses import FileResponse, HTMLResponse, JSONResponse
+from fastapi import FastAPI, Request, HTTPException, BackgroundTasks
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, Response
 from fastapi.templating import Jinja2Templates
-from pypdf import PdfWriter, PdfReader
+from pypdf import PdfWriter
+import pikepdf
+from streaming_form_data import StreamingFormDataParser
+from streaming_form_data.parser import ParseFailedException
+from streaming_form_data.targets import BaseTarget, ValueTarget
+from streaming_form_data.validators import MaxSizeValidator, ValidationError
 import img2pdf
 
 app = FastAPI()
@@ -18,7 +32,25 @@ templates = Jinja2Templates(directory="templates")
 UPLOAD_DIR = "temp_uploads"
 OUTPUT_DIR = "temp_outputs"
 MAX_MB_PER_FILE = 30  # Límite de 20MB por archivo para evitar colapsos
-ALLOWED_EXTENSIONS = {".pdf", ".jpg", ".jpeg", ".png"}
+ALLOWED_EXTENSIONS = frozenset({"pdf", "jpg", "jpeg", "png"})  # Sin punto, ver validar_extension
+EXT_PDF = frozenset({"pdf"})
+EXT_IMAGENES = frozenset({"jpg", "jpeg", "png"})
+MAX_ARCHIVOS_POR_REQUEST = 100  # Partes de archivo aceptadas en un mismo formulario
+MAX_BYTES_CAMPO = 1024  # Tope para los campos de texto (inicio, fin, grados)
+MAX_MB_POR_REQUEST = 200  # Tope de lo subido en un solo request, sumando todos los archivos
+UMBRAL_MEMORIA = 8 << 20  # Subidas más grandes que esto se vuelcan a disco
+MEMORIA_POR_REQUEST = 32 << 20  # Lo máximo que un request mantiene en RAM; el resto va a disco
+CHUNK = 4 << 20  # Buffer de 4MB para escrituras: menos syscalls que los 8KB por defecto
+# Operaciones PDF simultáneas por worker (semáforo y pool de procesos). Por
+# defecto todos los núcleos, lo correcto con un solo worker (`uvicorn main:app`).
+# Con varios workers, __main__ exporta PDFLEX_CONCURRENCY = CPUS // workers
+# para que el total del host no pase de los núcleos.
+CPUS = os.cpu_count() or 2
+CONCURRENCIA = max(1, int(os.getenv("PDFLEX_CONCURRENCY", CPUS)))
+# El reaper es solo respaldo (cada request borra lo suyo): la edad es holgada
+# para no tocar nunca archivos de un request que sigue en curso.
+REAPER_EDAD_MAX = 3600  # Segundos que puede quedar un archivo huérfano
+REAPER_INTERVALO = 300  # Cada cuánto se barren las carpetas temporales
 
 # Crear carpetas si no existen
 os.makedirs(UPLOAD_DIR, exist_ok=True)
@@ -26,56 +58,339 @@ os.makedirs(OUTPUT_DIR, exist_ok=True)
 
 # --- FUNCIONES DE AYUDA Y SEGURIDAD ---
 
-def limpiar_inicio(dir_path):
-    """Borra archivos viejos al arrancar el servidor."""
-    for filename in os.listdir(dir_path):
-        file_path = os.path.join(dir_path, filename)
-        try:
-            if os.path.isfile(file_path):
-                os.unlink(file_path)
-        except Exception:
-            pass
+class RespuestaArchivo(FileResponse):
+    """FileResponse que lee el archivo en bloques de 1MB en lugar de 64KB."""
+    chunk_size = 1 << 20
+
+def respuesta_pdf(pdf_bytes: bytes, filename: str, headers: dict = None) -> Response:
+    """Devuelve un PDF generado en memoria como descarga, sin pasar por disco."""
+    headers = {**(headers or {}), "Content-Disposition": f'attachment; filename="{filename}"'}
+    return Response(content=pdf_bytes, media_type="application/pdf", headers=headers)
 
-# Limpieza inicial al ejecutar el script
-limpiar_inicio(UPLOAD_DIR)
-limpiar_inicio(OUTPUT_DIR)
+def _uid() -> str:
+    """Id único de 22 caracteres (uuid4 en base64 url-safe) para nombres temporales."""
+    return base64.urlsafe_b64encode(uuid.uuid4().bytes).rstrip(b"=").decode("ascii")
 
 def validar_extension(filename: str, permitidas=ALLOWED_EXTENSIONS):
-    ext = os.path.splitext(filename)[1].lower()
-    if ext not in permitidas:
-        raise HTTPException(status_code=400, detail=f"Extensión no permitida: {ext}")
-    return ext
+    """Valida la extensión contra un frozenset sin punto y la devuelve con punto."""
+    base, dot, ext = filename.rpartition(".")
+    ext = ext.lower()
+    # Igual que splitext: ".pdf" es un nombre sin extensión, no una extensión
+    if not dot or not base.lstrip(".") or ext not in permitidas:
+        detalle = f".{ext}" if dot and base.lstrip(".") else ""
+        raise HTTPException(status_code=400, detail=f"Extensión no permitida: {detalle}")
+    return "." + ext
+
+def barrer_viejos(dir_path: str, edad_max: float):
+    """Borra los archivos de dir_path con más de edad_max segundos."""
+    limite = time.time() - edad_max
+    with os.scandir(dir_path) as entries:
+        for entry in entries:
+            try:
+                if entry.is_file() and entry.stat().st_mtime < limite:
+                    os.unlink(entry.path)
+            except OSError:
+                pass # En uso (Windows) o ya borrado por otro worker
 
 def borrar_archivos(file_paths: List[str]):
     """Tarea en segundo plano para limpiar archivos después de servir la respuesta."""
     for path in file_paths:
         try:
-            if os.path.exists(path):
-                os.remove(path)
-                print(f"🧹 Limpiado: {path}")
-        except Exception as e:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
             print(f"Error borrando {path}: {e}")
 
-def guardar_con_limite(upload_file: UploadFile, destino_path: str, max_mb: int):
+async def reaper():
     """
-    Guarda el archivo en bloques. Si supera max_mb, aborta y borra.
-    Evita que la RAM o el Disco se llenen con archivos gigantes.
+    Limpieza periódica de UPLOAD_DIR y OUTPUT_DIR. Es un respaldo del borrado
+    por request: levanta lo que quedó huérfano (caídas, ejecuciones
+    anteriores) cada REAPER_INTERVALO segundos.
     """
-    limit_bytes = max_mb * 1024 * 1024
-    file_size = 0
-    
-    with open(destino_path, "wb") as buffer:
-        while True:
-            chunk = upload_file.file.read(1024 * 1024) # Leer 1MB a la vez
-            if not chunk:
+    while True:
+        for dir_path in (UPLOAD_DIR, OUTPUT_DIR):
+            await asyncio.to_thread(barrer_viejos, dir_path, REAPER_EDAD_MAX)
+        await asyncio.sleep(REAPER_INTERVALO)
+
+class DestinoArchivos(BaseTarget):
+    """
+    Target de streaming-form-data: cada parte del campo se guarda en un
+    BytesIO y, si supera `umbral_memoria` o el request ya tiene
+    MEMORIA_POR_REQUEST en RAM, pasa a un NamedTemporaryFile en UPLOAD_DIR.
+    Tener una ruta real permite que el pool de procesos lea el archivo sin
+    copiarlo a memoria. Aplica los límites por archivo y por request.
+
+    No se usa SpooledTemporaryFile: al pasar a disco crea un archivo anónimo
+    sin ruta, que el pool de procesos no puede abrir.
+    """
+
+    def __init__(self, permitidas, max_mb: int, umbral_memoria: int = UMBRAL_MEMORIA):
+        super().__init__()
+        self.permitidas = permitidas
+        self.max_mb = max_mb
+        self.limit_bytes = max_mb * 1024 * 1024
+        self.umbral_memoria = umbral_memoria
+        self.entradas = []  # BytesIO o NamedTemporaryFile, uno por archivo
+        self.tamanos: List[int] = []  # Tamaño de cada entrada, para no hacer stat después
+        self._ext = ""
+        self._size = 0  # Bytes de la parte en curso
+        self._total = 0  # Bytes de todo el request
+        self._en_memoria = 0  # Bytes de las partes que siguen en BytesIO
+
+    def on_start(self):
+        if len(self.entradas) >= MAX_ARCHIVOS_POR_REQUEST:
+            raise HTTPException(status_code=413, detail=f"Máximo {MAX_ARCHIVOS_POR_REQUEST} archivos por solicitud.")
+        self._ext = validar_extension(self.multipart_filename or "", self.permitidas)
+        self.entradas.append(BytesIO())
+        self._size = 0
+
+    def on_data_received(self, chunk: bytes):
+        n = len(chunk)
+        self._size += n
+        self._total += n
+        if self._size > self.limit_bytes:
+            raise HTTPException(status_code=413, detail=f"El archivo excede el límite de {self.max_mb}MB.")
+        if self._total > MAX_MB_POR_REQUEST * 1024 * 1024:
+            raise HTTPException(status_code=413, detail=f"La solicitud excede el límite de {MAX_MB_POR_REQUEST}MB.")
+        if not en_disco(self.entradas[-1]):
+            if self._size > self.umbral_memoria or self._en_memoria + n > MEMORIA_POR_REQUEST:
+                self._volcar_a_disco()
+            else:
+                self._en_memoria += n
+        self.entradas[-1].write(chunk)
+
+    def _volcar_a_disco(self):
+        en_memoria = self.entradas[-1]
+        self._en_memoria -= en_memoria.tell()
+        archivo = NamedTemporaryFile(dir=UPLOAD_DIR, suffix=self._ext, delete=False, buffering=CHUNK)
+        archivo.write(en_memoria.getbuffer())
+        self.entradas[-1] = archivo
+
+    def on_finish(self):
+        self.entradas[-1].seek(0)
+        self.tamanos.append(self._size)
+
+    def tocara_disco(self, n: int) -> bool:
+        """
+        True si entregarle n bytes más puede escribir en disco: la parte en
+        curso ya se volcó o está por superar el umbral. Es conservador (una
+        parte ya terminada en disco también cuenta), nunca da falso negativo.
+        """
+        if self.entradas and en_disco(self.entradas[-1]):
+            return True
+        return self._size + n > self.umbral_memoria or self._en_memoria + n > MEMORIA_POR_REQUEST
+
+def en_disco(entrada) -> bool:
+    return not isinstance(entrada, BytesIO)
+
+def cerrar_entradas(entradas: list):
+    """Cierra las entradas y borra las que se volcaron a disco."""
+    for entrada in entradas:
+        entrada.close()
+        if en_disco(entrada):
+            try:
+                os.unlink(entrada.name)
+            except OSError:
+                pass # El reaper lo levanta después
+
+async def guardar_stream(
+    request: Request, campo: str, permitidas, max_mb: int, valores=(), umbral_memoria: int = UMBRAL_MEMORIA
+):
+    """
+    Parsea el multipart directamente desde request.stream(), sin pasar por
+    UploadFile. Devuelve un archivo abierto (ver DestinoArchivos) por cada
+    archivo del campo `campo`, sus tamaños y los valores de texto pedidos en `valores`. Los archivos pasan
+    a disco al superar `umbral_memoria`. Si algo falla, cierra lo que ya se
+    había recibido.
+    """
+    destino = DestinoArchivos(permitidas, max_mb, umbral_memoria)
+    campos_texto = {nombre: ValueTarget(validator=MaxSizeValidator(MAX_BYTES_CAMPO)) for nombre in valores}
+
+    try:
+        # El Content-Type se valida al crear el parser: va dentro del try
+        parser = StreamingFormDataParser(headers=request.headers)
+        parser.register(campo, destino)
+        for nombre, target in campos_texto.items():
+            parser.register(nombre, target)
+
+        async for chunk in request.stream():
+            # data_received escribe de forma síncrona: si va a tocar disco se
+            # hace en un hilo para no frenar el event loop
+            if destino.tocara_disco(len(chunk)):
+                await asyncio.to_thread(parser.data_received, chunk)
+            else:
+                parser.data_received(chunk)
+
+        textos = {nombre: t.value.decode() for nombre, t in campos_texto.items()}
+    except ValidationError:
+        cerrar_entradas(destino.entradas)
+        raise HTTPException(status_code=413, detail=f"Un campo de texto excede {MAX_BYTES_CAMPO} bytes.")
+    except (ParseFailedException, ValueError) as e:
+        # Sin Content-Type multipart, cuerpo mal formado o texto no UTF-8
+        cerrar_entradas(destino.entradas)
+        raise HTTPException(status_code=400, detail=f"Formulario inválido: {e}")
+    except Exception:
+        cerrar_entradas(destino.entradas)
+        raise
+
+    return destino.entradas, destino.tamanos, textos
+
+def leer_entero(valores: dict, nombre: str) -> int:
+    try:
+        return int(valores[nombre])
+    except (KeyError, ValueError):
+        # 422, igual que la validación de Form(...) que había antes
+        raise HTTPException(status_code=422, detail=f"Falta o es inválido el campo '{nombre}'.")
+
+class ContadorEscritura:
+    """Envuelve un archivo y cuenta los bytes escritos, para no hacer stat después."""
+
+    def __init__(self, f):
+        self.f = f
+        self.n = 0
+
+    def write(self, b) -> int:
+        escritos = self.f.write(b)
+        self.n += escritos
+        return escritos
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+def _comprimir_uno(entrada: Union[bytes, str], orig_size: int, output_path: str) -> tuple[int, int]:
+    """
+    Comprime un PDF y devuelve (tamaño_original, tamaño_comprimido).
+    `entrada` son los bytes del PDF, o su ruta si se volcó a disco; su
+    tamaño ya lo midió el parser al recibirlo.
+    Corre en el ProcessPoolExecutor: debe ser una función de módulo (picklable).
+    """
+    en_memoria = isinstance(entrada, bytes)
+
+    # QPDF recomprime los streams en C++; los ya comprimidos con filtros de
+    # imagen (DCT, JPX, JBIG2, CCITT) los deja tal cual.
+    with pikepdf.open(BytesIO(entrada) if en_memoria else entrada) as pdf, open(output_path, "wb", buffering=CHUNK) as f:
+        salida = ContadorEscritura(f)
+        pdf.save(
+            salida,
+            compress_streams=True,
+            stream_decode_level=pikepdf.StreamDecodeLevel.generalized,
+            object_stream_mode=pikepdf.ObjectStreamMode.generate,
+            linearize=False,
+        )
+
+    # Si no se logró reducir, se entrega el original tal cual
+    cand_size = salida.n
+    if cand_size >= orig_size:
+        if en_memoria:
+            with open(output_path, "wb", buffering=CHUNK) as f:
+                f.write(entrada)
+        else:
+            shutil.copyfile(entrada, output_path)
+        return orig_size, orig_size
+    return orig_size, cand_size
+
+def _tiene_estructura(pdf: pikepdf.Pdf) -> bool:
+    """True si el PDF tiene marcadores, destinos con nombre o formularios."""
+    root = pdf.Root
+    if "/Outlines" in root or "/AcroForm" in root or "/Dests" in root:
+        return True
+    return "/Names" in root and "/Dests" in root.Names
+
+def _unir_pdfs(entradas: list) -> bytes:
+    # QPDF copia los objetos de cada página sin decodificar sus streams.
+    # Los originales deben seguir abiertos hasta el save: ahí se leen los datos.
+    # pages.extend solo copia páginas: si algún PDF trae marcadores, destinos
+    # con nombre o /AcroForm se usa pypdf, que sí los fusiona.
+    buf = BytesIO()
+    with ExitStack() as stack:
+        pdf = stack.enter_context(pikepdf.new())
+        for entrada in entradas:
+            src = stack.enter_context(pikepdf.open(entrada))
+            if _tiene_estructura(src):
                 break
-            file_size += len(chunk)
-            if file_size > limit_bytes:
-                buffer.close()
-                if os.path.exists(destino_path):
-                    os.remove(destino_path)
-                raise HTTPException(status_code=413, detail=f"El archivo excede el límite de {max_mb}MB.")
-            buffer.write(chunk)
+            pdf.pages.extend(src.pages)
+        else:
+            pdf.save(buf, object_stream_mode=pikepdf.ObjectStreamMode.preserve)
+            return buf.getvalue()
+    return _unir_pdfs_pypdf(entradas)
+
+def _unir_pdfs_pypdf(entradas: list) -> bytes:
+    merger = PdfWriter()
+    for entrada in entradas:
+        entrada.seek(0)
+        merger.append(entrada)
+    buf = BytesIO()
+    merger.write(buf)
+    merger.close()
+    return buf.getvalue()
+
+def _imagenes_a_pdf(imagenes: list) -> bytes:
+    # img2pdf hace .read() de cada archivo; en un BytesIO leído completo desde
+    # el inicio eso devuelve su buffer interno sin copiarlo
+    return img2pdf.convert(imagenes)
+
+def _extraer_paginas(entrada, inicio: int, fin: int) -> bytes:
+    buf = BytesIO()
+    with pikepdf.open(entrada) as src:
+        total_pages = len(src.pages)
+
+        if inicio < 1 or fin > total_pages or inicio > fin:
+            raise HTTPException(status_code=400, detail=f"Rango inválido. El PDF tiene {total_pages} páginas.")
+
+        # Las páginas copiadas comparten recursos (fuentes, imágenes) vía xref
+        with pikepdf.new() as dst:
+            dst.pages.extend(src.pages[inicio - 1:fin])
+            dst.save(buf, object_stream_mode=pikepdf.ObjectStreamMode.generate)
+    return buf.getvalue()
+
+def _rotar_paginas(entrada, grados: int) -> bytes:
+    # Rotar es solo cambiar /Rotate en cada página: el contenido no se toca
+    buf = BytesIO()
+    with pikepdf.open(entrada) as pdf:
+        for page in pdf.pages:
+            page.rotate(grados, relative=True)
+        pdf.save(buf, object_stream_mode=pikepdf.ObjectStreamMode.preserve)
+    return buf.getvalue()
+
+def _empaquetar_zip(paths: List[str], zip_path: str):
+    # ZIP_STORED a propósito: los PDFs ya van comprimidos con Flate y volver
+    # a desinflarlos solo gasta CPU sin reducir el tamaño.
+    with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+        for path in paths:
+            # zf.write() copia en bloques de 8KB; aquí se copia de a CHUNK
+            zinfo = zipfile.ZipInfo.from_file(path, os.path.basename(path))
+            zinfo.compress_type = zipfile.ZIP_STORED
+            with open(path, "rb") as src, zf.open(zinfo, "w") as dst:
+                shutil.copyfileobj(src, dst, CHUNK)
+
+# --- CICLO DE VIDA ---
+
+EXECUTOR = None  # ProcessPoolExecutor para el trabajo CPU-bound, se crea al arrancar
+# Limita cuántas operaciones PDF corren a la vez en este worker: el resto
+# espera en cola en lugar de llenar la RAM. Igual al tamaño del pool de
+# procesos (en comprimir cada archivo ocupa un cupo).
+PDF_SEM = asyncio.Semaphore(CONCURRENCIA)
+REAPER_TASK = None
+
+@app.on_event("startup")
+async def arrancar():
+    global EXECUTOR, REAPER_TASK
+    # El reaper va aquí y no a nivel de módulo porque los procesos del pool
+    # re-importan este archivo. Solo borra archivos viejos, así que
+    # es seguro que cada worker tenga el suyo.
+    REAPER_TASK = asyncio.create_task(reaper())
+    # Nada de fork: este proceso ya tiene hilos (to_thread) y hacer fork de un
+    # proceso con hilos puede dejar locks tomados en el hijo.
+    contexto = multiprocessing.get_context("spawn" if sys.platform == "win32" else "forkserver")
+    EXECUTOR = ProcessPoolExecutor(max_workers=CONCURRENCIA, mp_context=contexto)
+
+@app.on_event("shutdown")
+async def apagar():
+    if REAPER_TASK is not None:
+        REAPER_TASK.cancel()
+    if EXECUTOR is not None:
+        EXECUTOR.shutdown(wait=False, cancel_futures=True)
 
 # --- RUTAS ---
 
@@ -85,213 +400,189 @@ async def home(request: Request):
 
 # 1. UNIR PDFS
 @app.post("/api/unir")
-async def api_unir(files: List[UploadFile], background_tasks: BackgroundTasks):
-    if not files:
-        return JSONResponse(status_code=400, content={"message": "No enviaste archivos."})
-    
-    merger = PdfWriter()
-    temp_paths = []
-    output_filename = f"Unido_{uuid.uuid4().hex}.pdf"
-    output_path = os.path.join(OUTPUT_DIR, output_filename)
+async def api_unir(request: Request):
+    entradas = []
     
     try:
-        for file in files:
-            validar_extension(file.filename, {".pdf"})
-            
-            safe_filename = f"{uuid.uuid4().hex}.pdf"
-            safe_path = os.path.join(UPLOAD_DIR, safe_filename)
-            
-            guardar_con_limite(file, safe_path, MAX_MB_PER_FILE)
-            temp_paths.append(safe_path)
-            merger.append(safe_path)
-        
-        merger.write(output_path)
-        merger.close()
-        
-        background_tasks.add_task(borrar_archivos, temp_paths + [output_path])
-        return FileResponse(output_path, filename="PDFlex_Unido.pdf", headers={"X-Success-Message": "Unión exitosa"})
+        entradas, _, _ = await guardar_stream(request, "files", EXT_PDF, MAX_MB_PER_FILE)
+        if not entradas:
+            return JSONResponse(status_code=400, content={"message": "No enviaste archivos."})
 
+        async with PDF_SEM:
+            pdf_bytes = await asyncio.to_thread(_unir_pdfs, entradas)
+        return respuesta_pdf(pdf_bytes, "PDFlex_Unido.pdf", headers={"X-Success-Message": "Unión exitosa"})
+
+    except HTTPException as e:
+        return JSONResponse(status_code=e.status_code, content={"message": e.detail})
     except Exception as e:
-        borrar_archivos(temp_paths)
         return JSONResponse(status_code=500, content={"message": str(e)})
+    finally:
+        cerrar_entradas(entradas)
 
 # 2. COMPRIMIR PDFS
-@app.post("/api/comprimir")
-async def api_comprimir(files: List[UploadFile], background_tasks: BackgroundTasks):
-    if not files:
-        return JSONResponse(status_code=400, content={"message": "Falta el archivo."})
+async def _comprimir_con_cupo(entrada, orig_size: int, output_path: str) -> tuple[int, int]:
+    """Comprime un archivo en el pool ocupando un cupo de PDF_SEM mientras dura."""
+    async with PDF_SEM:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(EXECUTOR, _comprimir_uno, entrada, orig_size, output_path)
 
+@app.post("/api/comprimir")
+async def api_comprimir(request: Request, background_tasks: BackgroundTasks):
     processed_files = []
-    temp_inputs = []
+    entradas = []
     total_orig = 0
     total_comp = 0
 
     try:
-        for file in files:
-            validar_extension(file.filename, {".pdf"})
-            
-            safe_filename = f"{uuid.uuid4().hex}.pdf"
-            input_path = os.path.join(UPLOAD_DIR, safe_filename)
-            guardar_con_limite(file, input_path, MAX_MB_PER_FILE)
-            temp_inputs.append(input_path)
-            
-            total_orig += os.path.getsize(input_path)
-
-            reader = PdfReader(input_path)
-            writer = PdfWriter()
-            
-            # Compresión de streams
-            for page in reader.pages:
-                writer.add_page(page)
-                writer.pages[-1].compress_content_streams()
-            
-            output_name = f"Mini_{uuid.uuid4().hex}.pdf"
-            output_path = os.path.join(OUTPUT_DIR, output_name)
-            
-            with open(output_path, "wb") as f:
-                writer.write(f)
-            
-            total_comp += os.path.getsize(output_path)
+        entradas, tamanos, _ = await guardar_stream(request, "files", EXT_PDF, MAX_MB_PER_FILE)
+        if not entradas:
+            return JSONResponse(status_code=400, content={"message": "Falta el archivo."})
+
+        jobs = []
+        for entrada, orig_size in zip(entradas, tamanos):
+            # Al proceso del pool se le pasa la ruta si está en disco, o los
+            # bytes si quedó en memoria (un archivo abierto no cruza procesos)
+            data = entrada.name if en_disco(entrada) else entrada.getvalue()
+            output_path = os.path.join(OUTPUT_DIR, f"Mini_{_uid()}.pdf")
             processed_files.append(output_path)
+            jobs.append(_comprimir_con_cupo(data, orig_size, output_path))
+
+        # Cada archivo se comprime en su propio proceso, en paralelo. Se espera
+        # a todos aunque alguno falle: si no, los que siguen corriendo crearían
+        # sus salidas después del borrado del except y quedarían huérfanas.
+        resultados = await asyncio.gather(*jobs, return_exceptions=True)
+        for resultado in resultados:
+            if isinstance(resultado, BaseException):
+                raise resultado
+        for orig_size, comp_size in resultados:
+            total_orig += orig_size
+            total_comp += comp_size
 
         # Preparar descarga (Zip o archivo único)
         if len(processed_files) == 1:
             final_path = processed_files[0]
             download_name = "PDFlex_Comprimido.pdf"
         else:
-            final_path = os.path.join(OUTPUT_DIR, f"Pack_{uuid.uuid4().hex}.zip")
-            with zipfile.ZipFile(final_path, 'w') as zf:
-                for f in processed_files:
-                    zf.write(f, os.path.basename(f))
+            final_path = os.path.join(OUTPUT_DIR, f"Pack_{_uid()}.zip")
+            await asyncio.to_thread(_empaquetar_zip, processed_files, final_path)
             processed_files.append(final_path) # Agregar zip a la lista de borrado
             download_name = "PDFlex_Pack.zip"
 
         ahorro = total_orig - total_comp
         porcentaje = int((ahorro / total_orig) * 100) if total_orig > 0 else 0
         
-        background_tasks.add_task(borrar_archivos, temp_inputs + processed_files)
-        
         headers = {
             "Access-Control-Expose-Headers": "X-Savings-Percent",
             "X-Savings-Percent": str(porcentaje)
         }
-        return FileResponse(final_path, filename=download_name, headers=headers)
+        background_tasks.add_task(borrar_archivos, processed_files)
+        return RespuestaArchivo(final_path, filename=download_name, headers=headers)
 
+    except HTTPException as e:
+        borrar_archivos(processed_files)
+        return JSONResponse(status_code=e.status_code, content={"message": e.detail})
     except Exception as e:
-        borrar_archivos(temp_inputs + processed_files)
+        borrar_archivos(processed_files)
         return JSONResponse(status_code=500, content={"message": str(e)})
+    finally:
+        cerrar_entradas(entradas)
 
 # 3. IMÁGENES A PDF
 @app.post("/api/img2pdf")
-async def api_img2pdf(files: List[UploadFile], background_tasks: BackgroundTasks):
-    if not files:
-        return JSONResponse(status_code=400, content={"message": "No hay imágenes."})
-    
-    img_paths = []
-    output_filename = f"Album_{uuid.uuid4().hex}.pdf"
-    output_path = os.path.join(OUTPUT_DIR, output_filename)
+async def api_img2pdf(request: Request):
+    imagenes = []
     
     try:
-        for file in files:
-            ext = validar_extension(file.filename, {".jpg", ".jpeg", ".png"})
-            
-            safe_filename = f"{uuid.uuid4().hex}{ext}"
-            path = os.path.join(UPLOAD_DIR, safe_filename)
-            guardar_con_limite(file, path, MAX_MB_PER_FILE)
-            img_paths.append(path)
+        # Umbral = límite por archivo: una imagen solo pasa a disco si el
+        # request ya tiene MEMORIA_POR_REQUEST en RAM
+        imagenes, _, _ = await guardar_stream(
+            request, "files", EXT_IMAGENES, MAX_MB_PER_FILE,
+            umbral_memoria=MAX_MB_PER_FILE * 1024 * 1024,
+        )
+        if not imagenes:
+            return JSONResponse(status_code=400, content={"message": "No hay imágenes."})
         
-        pdf_bytes = img2pdf.convert(img_paths)
-        with open(output_path, "wb") as f:
-            f.write(pdf_bytes)
-            
-        background_tasks.add_task(borrar_archivos, img_paths + [output_path])
-        return FileResponse(output_path, filename="PDFlex_Album.pdf")
+        async with PDF_SEM:
+            pdf_bytes = await asyncio.to_thread(_imagenes_a_pdf, imagenes)
+        return respuesta_pdf(pdf_bytes, "PDFlex_Album.pdf")
 
+    except HTTPException as e:
+        return JSONResponse(status_code=e.status_code, content={"message": e.detail})
     except Exception as e:
-        borrar_archivos(img_paths)
         return JSONResponse(status_code=500, content={"message": str(e)})
+    finally:
+        cerrar_entradas(imagenes)
 
 # 4. EXTRAER PÁGINAS (SPLIT)
 @app.post("/api/extraer")
-async def api_extraer(
-    file: UploadFile, 
-    background_tasks: BackgroundTasks,
-    inicio: int = Form(...), 
-    fin: int = Form(...),
-):
-    temp_paths = []
+async def api_extraer(request: Request):
+    entradas = []
     
     try:
-        validar_extension(file.filename, {".pdf"})
-        
-        safe_filename = f"{uuid.uuid4().hex}.pdf"
-        input_path = os.path.join(UPLOAD_DIR, safe_filename)
-        guardar_con_limite(file, input_path, MAX_MB_PER_FILE)
-        temp_paths.append(input_path)
-        
-        reader = PdfReader(input_path)
-        writer = PdfWriter()
-        total_pages = len(reader.pages)
-        
-        if inicio < 1 or fin > total_pages or inicio > fin:
-            raise HTTPException(status_code=400, detail=f"Rango inválido. El PDF tiene {total_pages} páginas.")
+        entradas, _, valores = await guardar_stream(
+            request, "file", EXT_PDF, MAX_MB_PER_FILE, valores=("inicio", "fin")
+        )
+        if len(entradas) != 1:
+            raise HTTPException(status_code=400, detail="Envía exactamente un PDF.")
+        inicio = leer_entero(valores, "inicio")
+        fin = leer_entero(valores, "fin")
 
-        for i in range(inicio - 1, fin):
-            writer.add_page(reader.pages[i])
-            
-        output_filename = f"Extraido_{uuid.uuid4().hex}.pdf"
-        output_path = os.path.join(OUTPUT_DIR, output_filename)
-        
-        with open(output_path, "wb") as f:
-            writer.write(f)
-            
-        background_tasks.add_task(borrar_archivos, temp_paths + [output_path])
-        return FileResponse(output_path, filename="PDFlex_Extraido.pdf")
+        async with PDF_SEM:
+            pdf_bytes = await asyncio.to_thread(_extraer_paginas, entradas[0], inicio, fin)
+        return respuesta_pdf(pdf_bytes, "PDFlex_Extraido.pdf")
 
+    except HTTPException as e:
+        return JSONResponse(status_code=e.status_code, content={"message": e.detail})
     except Exception as e:
-        borrar_archivos(temp_paths)
         return JSONResponse(status_code=500, content={"message": str(e)})
+    finally:
+        cerrar_entradas(entradas)
 
 # 5. ROTAR PDF
 @app.post("/api/rotar")
-async def api_rotar(
-    file: UploadFile, 
-    background_tasks: BackgroundTasks,
-    grados: int = Form(...),
-):
-    temp_paths = []
+async def api_rotar(request: Request):
+    entradas = []
     
     try:
-        validar_extension(file.filename, {".pdf"})
+        entradas, _, valores = await guardar_stream(
+            request, "file", EXT_PDF, MAX_MB_PER_FILE, valores=("grados",)
+        )
+        if len(entradas) != 1:
+            raise HTTPException(status_code=400, detail="Envía exactamente un PDF.")
+        grados = leer_entero(valores, "grados")
         
         if grados not in [90, 180, 270]:
             raise HTTPException(status_code=400, detail="Solo se permiten 90, 180 o 270 grados.")
 
-        safe_filename = f"{uuid.uuid4().hex}.pdf"
-        input_path = os.path.join(UPLOAD_DIR, safe_filename)
-        guardar_con_limite(file, input_path, MAX_MB_PER_FILE)
-        temp_paths.append(input_path)
-        
-        reader = PdfReader(input_path)
-        writer = PdfWriter()
-        
-        for page in reader.pages:
-            page.rotate(grados)
-            writer.add_page(page)
-            
-        output_filename = f"Rotado_{uuid.uuid4().hex}.pdf"
-        output_path = os.path.join(OUTPUT_DIR, output_filename)
-        
-        with open(output_path, "wb") as f:
-            writer.write(f)
-            
-        background_tasks.add_task(borrar_archivos, temp_paths + [output_path])
-        return FileResponse(output_path, filename="PDFlex_Rotado.pdf")
+        async with PDF_SEM:
+            pdf_bytes = await asyncio.to_thread(_rotar_paginas, entradas[0], grados)
+        return respuesta_pdf(pdf_bytes, "PDFlex_Rotado.pdf")
 
+    except HTTPException as e:
+        return JSONResponse(status_code=e.status_code, content={"message": e.detail})
     except Exception as e:
-        borrar_archivos(temp_paths)
         return JSONResponse(status_code=500, content={"message": str(e)})
+    finally:
+        cerrar_entradas(entradas)
 
 if __name__ == "__main__":
     print("🚀 PDFlex Seguro iniciando en http://127.0.0.1:8000")
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # Un worker por núcleo reparte los núcleos entre requests: cada worker queda
+    # con CONCURRENCIA = 1, así que los N archivos de un /api/comprimir se hacen
+    # de a uno. Con PDFLEX_WORKERS=1 hay un solo worker con un pool de CPUS
+    # procesos y esos N archivos se comprimen en paralelo.
+    workers = max(1, int(os.getenv("PDFLEX_WORKERS", CPUS)))
+    # Los workers importan este módulo de nuevo y heredan la variable
+    os.environ.setdefault("PDFLEX_CONCURRENCY", str(max(1, CPUS // workers)))
+
+    # loop/http "auto" eligen uvloop y httptools si están instalados
+    # (uvloop no existe en Windows, ahí cae al loop de asyncio)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=workers,
+        loop="auto",
+        http="auto",
+        backlog=2048,
+    )